@@ -1,14 +1,20 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner.exceptions import ScriptControlException
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import hashlib
 from google.oauth2 import service_account
 from google.cloud import storage
 from google.api_core.exceptions import NotFound
-import os
-from datetime import datetime
+import re
+from datetime import datetime, timedelta
 import math
-from google.auth.transport.requests import Request # Import Request here
+from collections import namedtuple
+from functools import lru_cache
+from google.auth.transport.requests import AuthorizedSession
 
 # ==== STREAMLIT PAGE CONFIG (MUST BE FIRST STREAMLIT COMMAND) ====
 st.set_page_config(page_title="Veo 2.0 Video Generator", layout="wide")
@@ -19,6 +25,13 @@ MODEL_ID = "veo-2.0-generate-001"
 GCS_BUCKET_NAME = "applelamps-unique-veo-bucket"
 GCS_SUBFOLDER = "veo_outputs"
 VIDEOS_PER_PAGE = 6 # Number of videos to show per page in the library
+LIBRARY_CACHE_TTL = 60 # Seconds a bucket listing is reused before GCS is listed again
+SEARCH_INDEX_THRESHOLD = 1000 # Libraries larger than this get a trigram index for search instead of a linear scan
+SIGNED_URL_EXPIRATION = timedelta(minutes=30) # Lifetime of signed URLs handed to the browser for playback
+POLL_INITIAL_DELAY = 2.0 # Seconds before the first status poll; grows exponentially after that
+POLL_MAX_DELAY = 30.0 # Upper bound on the wait between status polls
+POLL_BACKOFF_FACTOR = 1.5 # Multiplier applied to the poll delay after each poll
+POLL_TIMEOUT = 420 # Total seconds to wait for a generation before giving up
 
 # Placeholder image (base64 encoded or a URL)
 PLACEHOLDER_IMAGE = "https://via.placeholder.com/400x300?text=Video+Preview"  # Example URL
@@ -32,86 +45,171 @@ SCOPES = [
 # Function to get credentials safely
 @st.cache_resource # Cache credentials for the session
 def get_credentials():
-    """Retrieves and refreshes GCP credentials from Streamlit secrets."""
-    creds = service_account.Credentials.from_service_account_info(
+    """Loads GCP credentials from Streamlit secrets (no token is minted until one is needed)."""
+    return service_account.Credentials.from_service_account_info(
         st.secrets["gcp"],
         scopes=SCOPES
     )
-    creds.refresh(Request())
-    return creds
 
-credentials = get_credentials()
-access_token = credentials.token
+# ==== HTTP SESSION ====
+@st.cache_resource # One pooled, keep-alive session shared by all Vertex AI calls
+def get_http_session():
+    """Creates an authorized session that reuses TLS connections, refreshes its token and retries transient failures."""
+    session = AuthorizedSession(get_credentials()) # Attaches a bearer token, refreshing it when expired or on a 401
+    retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[500, 502, 503, 504]) # urllib3 never retries POSTs on status, only on connect errors
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
+    session.headers.update({"Content-Type": "application/json"})
+    return session
 
 # ==== BUCKET MANAGEMENT ====
 @st.cache_resource # Cache storage client
 def get_storage_client():
-    """Gets a GCS storage client instance."""
-    return storage.Client(project=PROJECT_ID, credentials=credentials)
+    """Gets a GCS storage client instance (built once per process)."""
+    return storage.Client(project=PROJECT_ID, credentials=get_credentials())
 
 storage_client = get_storage_client()
 
-def ensure_bucket_exists(bucket_name):
+_GCS_URI_RE = re.compile(r"^gs://([^/]+)/(.+)$")
+
+def parse_gcs_uri(gcs_uri):
+    """Splits a gs://bucket/path URI into (bucket_name, blob_path)."""
+    match = _GCS_URI_RE.match(gcs_uri)
+    if not match:
+        raise ValueError(f"Not a valid GCS object URI: {gcs_uri}")
+    return match.group(1), match.group(2)
+
+# Bucket state doesn't change between reruns, so check (and create) it once per process.
+# Failures raise instead of returning, so they are not cached and the next generation retries.
+@st.cache_resource(show_spinner=False)
+def _bucket_ready(bucket_name):
     """Checks if the GCS bucket exists and creates it if not."""
     try:
         storage_client.get_bucket(bucket_name)
     except NotFound:
-        try:
-            storage_client.create_bucket(bucket_name, location="us-central1")
-            st.toast(f"Created GCS bucket: {bucket_name}")
-        except Exception as e:
-            st.error(f"Failed to create bucket {bucket_name}: {e}")
-
-
-def download_from_gcs(gcs_uri, local_path):
-    """Downloads a file from GCS to a local path."""
+        storage_client.create_bucket(bucket_name, location="us-central1")
+    return True
+
+
+# Generated videos never change once written, so their bytes can be memoized by URI
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600) # Bounded to keep memory in check
+def fetch_blob_bytes(gcs_uri):
+    """Downloads a GCS object into memory and returns its bytes (raises on failure)."""
+    bucket_name, blob_path = parse_gcs_uri(gcs_uri)
+    bucket = storage_client.bucket(bucket_name)
+    return bucket.blob(blob_path).download_as_bytes(raw_download=True)
+
+# Signing is local (service account key), but cache anyway so reruns reuse the same URL and the
+# browser can keep its buffered video; the TTL is shorter than the URL lifetime so a cached URL never expires
+@st.cache_data(ttl=SIGNED_URL_EXPIRATION - timedelta(minutes=5), show_spinner=False)
+def get_signed_url(gcs_uri, download_filename=None):
+    """Returns a short-lived V4 signed URL so the browser can stream (or, given a filename, download) the object directly from GCS."""
+    bucket_name, blob_path = parse_gcs_uri(gcs_uri)
+    blob = storage_client.bucket(bucket_name).blob(blob_path)
+    # An attachment disposition makes GCS serve it as a file download instead of inline playback
+    disposition = f'attachment; filename="{download_filename}"' if download_filename else None
+    return blob.generate_signed_url(version="v4", expiration=SIGNED_URL_EXPIRATION, method="GET", response_disposition=disposition)
+
+# Shared across sessions by reference: unlike st.cache_data, a hit doesn't re-hash args or unpickle a copy of the list
+@st.cache_resource
+def _uri_cache():
+    """Returns the process-wide {(bucket_name, prefix): (listing, expires_at)} listing cache."""
+    return {}
+
+def clear_video_uri_cache():
+    """Drops cached bucket listings so the next call lists GCS again (e.g. after a new generation)."""
+    _uri_cache().clear()
+
+# One library video, with everything the cards need derived once at listing time instead of on every render.
+# key is a short object-name hash used for widget keys, so a video keeps its widgets across pages/searches.
+VideoEntry = namedtuple("VideoEntry", "uri filename key created size")
+
+# Creation times never change, so each card's label is formatted once instead of on every rerun
+@lru_cache(maxsize=512)
+def format_card_date(created):
+    """Formats a video's creation time for its library card."""
+    return created.strftime('%Y-%m-%d %H:%M') if created else "Date unknown"
+
+def build_trigram_index(uris_lower):
+    """Maps every 3-character substring to the set of positions of the URIs containing it."""
+    index = {}
+    for i, uri in enumerate(uris_lower):
+        for j in range(len(uri) - 2):
+            index.setdefault(uri[j:j + 3], set()).add(i)
+    return index
+
+def search_videos(listing, query):
+    """Returns the videos of a list_videos() listing whose URI contains query (case-insensitive), keeping their order."""
+    videos, uris_lower, trigram_index = listing
+    query = query.lower() # Lowercase the query once; the URIs were lowercased when listed
+    if trigram_index is None or len(query) < 3:
+        return [video for video, uri in zip(videos, uris_lower) if query in uri]
+    # Candidates must contain every trigram of the query; intersect starting from the rarest
+    postings = sorted((trigram_index.get(query[j:j + 3], set()) for j in range(len(query) - 2)), key=len)
+    candidates = postings[0].intersection(*postings[1:])
+    # Trigrams can match out of order, so confirm the substring on the (few) candidates
+    return [videos[i] for i in sorted(candidates) if query in uris_lower[i]]
+
+def list_videos(bucket_name, prefix):
+    """Lists videos in the specified GCS bucket and prefix as a (videos, uris_lower, trigram_index) listing."""
+    # videos holds VideoEntry tuples, newest first; uris_lower and the optional
+    # trigram index (built only for large libraries) let search_videos filter without re-lowercasing
+    # Cache the list of URIs for a short time to avoid excessive GCS calls
+    cache = _uri_cache()
+    entry = cache.get((bucket_name, prefix))
+    if entry and entry[1] > time.monotonic():
+        return entry[0]
     try:
-        parts = gcs_uri.replace("gs://", "").split("/", 1)
-        bucket_name = parts[0]
-        blob_path = parts[1]
         bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_path)
-        # Ensure local directory exists before downloading
-        local_dir = os.path.dirname(local_path)
-        if local_dir and not os.path.exists(local_dir):
-             os.makedirs(local_dir)
-        blob.download_to_filename(local_path)
-        return True
+        # Filter to .mp4 server-side and request only the fields we use, so GCS pages
+        # through fewer objects and returns a much smaller listing payload
+        mp4_blobs = bucket.list_blobs(
+            prefix=prefix,
+            match_glob="**/*.mp4",
+            projection="noAcl",
+            fields="items(name,timeCreated,size),nextPageToken"
+        )
+        # Reduce each Blob to a small (time_created, name, size) tuple as pages stream in, so full Blob
+        # objects are never all held in memory at once, then sort newest first.
+        # The listing already carries the card metadata, so no per-object (or batched) lookups are needed;
+        # storage_client.batch() is the way to go if fields the listing can't return are ever displayed.
+        sorted_entries = sorted(((blob.time_created, blob.name, blob.size) for blob in mp4_blobs), reverse=True)
+        videos = tuple( # Immutable: shared by all sessions
+            VideoEntry(
+                uri=f"gs://{bucket_name}/{name}",
+                filename=name.rsplit("/", 1)[-1],
+                key=hashlib.sha1(name.encode()).hexdigest()[:16],
+                created=created,
+                size=size
+            )
+            for created, name, size in sorted_entries
+        )
     except Exception as e:
-        st.error(f"Error downloading {gcs_uri}: {e}")
-        return False
-
-# Cache the list of URIs for a short time to avoid excessive GCS calls
-@st.cache_data(ttl=60) # Cache for 60 seconds
-def list_video_uris(_bucket_name, _prefix): # Use dummy args for caching
-    """Lists video URIs from the specified GCS bucket and prefix, sorted by newest first."""
-    # Use actual constants inside function to ensure cache uses them
-    bucket_name = GCS_BUCKET_NAME
-    prefix = GCS_SUBFOLDER
+        st.error(f"Error listing videos from gs://{bucket_name}/{prefix}: {e}")
+        return ((), (), None) # Errors are not cached, so the next rerun retries
+    # Search support is built once per listing instead of once per keystroke
+    uris_lower = tuple(video.uri.lower() for video in videos)
+    trigram_index = build_trigram_index(uris_lower) if len(videos) > SEARCH_INDEX_THRESHOLD else None
+    listing = (videos, uris_lower, trigram_index)
+    cache[(bucket_name, prefix)] = (listing, time.monotonic() + LIBRARY_CACHE_TTL)
+    return listing
+
+# ==== VIDEO GENERATION FUNCTIONS ====
+def generation_key(prompt, duration, aspect_ratio):
+    """Returns an idempotency key identifying a generation request by its inputs."""
+    return hashlib.sha256(f"{prompt}|{duration}|{aspect_ratio}".encode()).hexdigest()
+
+def submit_video_generation(prompt, duration, aspect_ratio):
+    """Starts a Vertex AI video generation job and returns (operation_name, error)."""
     try:
-        bucket = storage_client.bucket(bucket_name)
-        blobs = list(bucket.list_blobs(prefix=prefix)) # Convert iterator to list for sorting
-        # Filter and sort blobs by creation time descending (newest first)
-        mp4_blobs = [blob for blob in blobs if blob.name.endswith(".mp4")]
-        sorted_blobs = sorted(mp4_blobs, key=lambda b: b.time_created, reverse=True)
-        return [f"gs://{bucket_name}/{blob.name}" for blob in sorted_blobs]
+        _bucket_ready(GCS_BUCKET_NAME) # Ensure bucket exists before proceeding (cached after first success)
     except Exception as e:
-        st.error(f"Error listing videos from gs://{bucket_name}/{prefix}: {e}")
-        return []
-
-# ==== VIDEO GENERATION FUNCTION ====
-def generate_video(prompt, duration, aspect_ratio):
-    """Sends request to Vertex AI to generate video and polls for completion."""
-    ensure_bucket_exists(GCS_BUCKET_NAME) # Ensure bucket exists before proceeding
+        return None, f"Failed to prepare bucket {GCS_BUCKET_NAME}: {e}"
     gcs_uri = f"gs://{GCS_BUCKET_NAME}/{GCS_SUBFOLDER}/"
     endpoint = (
         f"https://us-central1-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}"
         f"/locations/us-central1/publishers/google/models/{MODEL_ID}:predictLongRunning"
     )
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    session = get_http_session()
     payload = {
         "instances": [
             {"prompt": prompt}
@@ -125,23 +223,39 @@ def generate_video(prompt, duration, aspect_ratio):
         }
     }
     try:
-        res = requests.post(endpoint, headers=headers, json=payload, timeout=30) # Added timeout
+        res = session.post(endpoint, json=payload, timeout=30) # Added timeout
         res.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
     except requests.exceptions.RequestException as e:
         return None, f"API Request Error initiating generation: {e}"
     except Exception as e:
          return None, f"Unexpected error initiating generation: {e}"
 
+    return res.json()["name"], None
 
-    operation_name = res.json()["name"]
+def poll_video_generation(operation_name, on_progress=None, started=None):
+    """Polls a Vertex AI generation job until it completes and returns (video_uri, error)."""
+    # on_progress(elapsed_seconds, percent_or_None) is called about once a second while waiting,
+    # so the caller's progress UI keeps moving between the (increasingly spaced) polls.
+    # Each call is a point where Streamlit may raise a pending rerun; it propagates so the caller can resume.
+    # started (time.monotonic() at submission) keeps a resumed job's elapsed time and deadline from restarting
+    session = get_http_session()
     poll_endpoint = (
         f"https://us-central1-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}"
         f"/locations/us-central1/publishers/google/models/{MODEL_ID}:fetchPredictOperation"
     )
-    # Increased polling time slightly, reduced iterations
-    for i in range(40): # Poll for up to ~6-7 minutes
+    # Poll with exponential backoff: tight early polls catch quick jobs, capped delay keeps long jobs cheap
+    delay = POLL_INITIAL_DELAY
+    started = time.monotonic() if started is None else started
+    deadline = started + POLL_TIMEOUT
+    reported = None # Last progressPercent reported by the job, if any
+    while time.monotonic() < deadline:
+        wait = delay
+        retry_after = 0.0 # Seconds the server asked us to hold off (Retry-After), applied after the wait is chosen
         try:
-            poll_res = requests.post(poll_endpoint, headers=headers, json={"operationName": operation_name}, timeout=15)
+            poll_res = session.post(poll_endpoint, json={"operationName": operation_name}, timeout=30)
+            retry_after_header = poll_res.headers.get("Retry-After", "")
+            if retry_after_header.isdigit():
+                retry_after = float(retry_after_header)
             poll_res.raise_for_status()
             poll = poll_res.json()
             if poll.get("done"):
@@ -155,18 +269,31 @@ def generate_video(prompt, duration, aspect_ratio):
                 else:
                     st.warning(f"Generation completed but no video URI found. Full response: {poll}")
                     return None, "Generation completed but no video URI found in response."
-            # Optional: Update progress based on polling attempts
-            # st.session_state.progress = 30 + int(60 * (i / 40)) # Example progress update
-
-            time.sleep(10) # Wait before next poll
+            # When the job reports progress, aim the next poll at its projected finish instead of the fixed backoff
+            progress = poll.get("metadata", {}).get("progressPercent")
+            if isinstance(progress, (int, float)) and 0 < progress < 100:
+                reported = progress
+                remaining = (time.monotonic() - started) * (100 - progress) / progress
+                wait = min(max(remaining, POLL_INITIAL_DELAY), POLL_MAX_DELAY)
         except requests.exceptions.RequestException as e:
             # Continue polling even if one poll request fails, but log it
             st.warning(f"Polling request failed: {e}. Retrying...")
-            time.sleep(10) # Wait a bit longer after a failed poll
+        except ScriptControlException:
+            raise # A rerun/stop interrupting this session (it derives from Exception) must not be retried as a poll error
         except Exception as e:
              # Log unexpected errors during polling but continue if possible
             st.warning(f"Unexpected error during polling: {e}. Retrying...")
-            time.sleep(10)
+
+        # Throttled (429/503) or not, never poll sooner than the server asks - whatever backoff/progress chose
+        wait = max(wait, retry_after)
+
+        # Wait before next poll (failed polls back off the same way), in short slices when reporting progress
+        wake = min(time.monotonic() + wait, deadline)
+        while (left := wake - time.monotonic()) > 0:
+            time.sleep(min(left, 1.0) if on_progress else left)
+            if on_progress:
+                on_progress(time.monotonic() - started, reported)
+        delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY)
 
 
     return None, "Timeout waiting for video generation to complete."
@@ -182,9 +309,18 @@ if 'current_page' not in st.session_state:
     st.session_state.current_page = 1 # For library pagination
 if 'last_generated_video' not in st.session_state:
     st.session_state.last_generated_video = None # Track last success
-
-# Custom CSS
-st.markdown("""
+if 'library_opened' not in st.session_state:
+    st.session_state.library_opened = False # Library GCS work is deferred until the user opens it
+if 'generation_request' not in st.session_state:
+    st.session_state.generation_request = None # Inputs of the generation in progress, so an interrupted run can resume it
+if 'inflight_op' not in st.session_state:
+    st.session_state.inflight_op = None # {"key", "name", "submitted"} of the Vertex job this session is waiting on
+
+# Custom CSS (built once per process; see _css below)
+@st.cache_data(show_spinner=False)
+def _css():
+    """Returns the app's static stylesheet markup."""
+    return """
 <style>
 /* General */
 body {
@@ -253,21 +389,6 @@ body {
 }
 
 /* Video Card in Library */
-.video-card {
-    background-color: #ffffff; /* White background */
-    border-radius: 0.75rem; /* Match header */
-    padding: 1.25rem; /* Increased padding */
-    margin-bottom: 1.5rem;
-    border: 1px solid #e0e3e8;
-    box-shadow: 0 2px 4px rgba(0, 0, 0, 0.05);
-    transition: box-shadow 0.3s ease;
-    height: 100%; /* Make cards in a row equal height */
-    display: flex;
-    flex-direction: column;
-}
-.video-card:hover {
-    box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1);
-}
 .video-title {
   font-size: 1rem; /* Slightly smaller */
   font-weight: 600; /* Bolder */
@@ -283,23 +404,6 @@ body {
     margin-bottom: 0.75rem;
     flex-grow: 0;
 }
-.video-content { /* Container for video/placeholder */
-    flex-grow: 1; /* Allow video content to fill space */
-    display: flex;
-    align-items: center; /* Center placeholder vertically */
-    justify-content: center; /* Center placeholder horizontally */
-    margin-bottom: 1rem; /* Space before buttons/expander */
-    min-height: 150px; /* Ensure content area has minimum height */
-}
-.video-content .stVideo, .video-content .stImage { /* Ensure video/image element scales */
-    width: 100%;
-    max-height: 300px; /* Optional: Limit video height */
-    object-fit: contain; /* Ensure video/image fits within bounds */
-}
-.video-actions { /* Container for button/expander */
-    flex-grow: 0;
-    margin-top: auto; /* Push actions to bottom */
-}
 
 
 /* Messages */
@@ -337,18 +441,6 @@ body {
 
 
 /* Pagination */
-.pagination-container {
-    display: flex;
-    justify-content: center;
-    align-items: center;
-    margin-top: 1.5rem;
-    margin-bottom: 1rem; /* Add space below pagination */
-    gap: 0.5rem; /* Spacing between elements */
-}
-.pagination-container .stButton>button {
-    width: auto; /* Allow buttons to size naturally */
-    padding: 0.5rem 1rem; /* Adjust padding */
-}
 .pagination-info {
     text-align: center;
     color: #6c757d;
@@ -357,7 +449,15 @@ body {
 }
 
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Emitted on every rerun on purpose: Streamlit drops elements a rerun doesn't re-emit,
+# so a "send once" session-state guard would strip the styles after the first interaction.
+st.markdown(_css(), unsafe_allow_html=True)
+
+def subheader(title):
+    """Renders a styled section subheader."""
+    st.markdown(f'<div class="subheader"><h3>{title}</h3></div>', unsafe_allow_html=True)
 
 # Header
 st.markdown('<div class="main-header"><h1>Veo 2.0 Text-to-Video Generator</h1></div>', unsafe_allow_html=True)
@@ -366,26 +466,30 @@ st.markdown('<div class="main-header"><h1>Veo 2.0 Text-to-Video Generator</h1></
 tab1, tab2 = st.tabs(["✨ Generate New Video", "🎬 Video Library"])
 
 # Example prompts
-example_prompts = [
+example_prompts = (
     "A cinematic drone shot over a misty forest at sunrise",
     "A futuristic city with flying cars and neon lights",
     "A peaceful beach with gentle waves at sunset",
     "An astronaut walking on the surface of Mars",
-]
+)
+# (key, label, help) for each example button, built once instead of formatted on every rerun
+example_buttons = tuple(
+    (f"ex_{i}", ex_prompt, f"Use prompt: '{ex_prompt}'") for i, ex_prompt in enumerate(example_prompts)
+)
+
+# Function to update prompt in session state (module level, so every rerun passes the same callback)
+def set_prompt(text):
+    st.session_state.prompt = text
+    # No explicit rerun needed here, text_area will update via Streamlit's flow
+    # when the button click causes a script rerun naturally.
 
 # --- Generate Tab ---
 with tab1:
-    # Function to update prompt in session state
-    def set_prompt(text):
-        st.session_state.prompt = text
-        # No explicit rerun needed here, text_area will update via Streamlit's flow
-        # when the button click causes a script rerun naturally.
-
     # Layout with columns
     prompt_col, preview_col = st.columns([1, 1])
 
     with prompt_col:
-        st.markdown('<div class="subheader"><h3>Create Your Video</h3></div>', unsafe_allow_html=True)
+        subheader("Create Your Video")
 
         # Prompt input
         st.markdown("**1. Enter your prompt:**")
@@ -404,10 +508,10 @@ with tab1:
         # Example prompts section
         st.markdown("**Or try an example prompt:**")
         cols = st.columns(2)
-        for i, ex_prompt in enumerate(example_prompts):
+        for i, (ex_key, ex_prompt, ex_help) in enumerate(example_buttons):
             with cols[i % 2]:
                 # Use on_click to set prompt. Rerun happens automatically.
-                st.button(label=ex_prompt, key=f"ex_{i}", on_click=set_prompt, args=[ex_prompt], help=f"Use prompt: '{ex_prompt}'")
+                st.button(label=ex_prompt, key=ex_key, on_click=set_prompt, kwargs={"text": ex_prompt}, help=ex_help)
                 # if st.button(...): # Old way
                 #    st.rerun() # Rerun needed to update text_area value visually
 
@@ -427,9 +531,11 @@ with tab1:
 
         st.divider()
 
-        # Generation button - Disabled state managed by session_state.generating
+        # Generation button - Disabled state managed by session_state.generating.
+        # Rendered in a slot so it can be swapped for a busy placeholder the moment generation starts.
         st.markdown("**3. Generate!**")
-        generate_btn = st.button(
+        generate_slot = st.empty()
+        generate_btn = generate_slot.button(
             "🎬 Generate Video",
             use_container_width=True,
             type="primary", # Use Streamlit's primary button styling
@@ -438,98 +544,114 @@ with tab1:
         )
 
     with preview_col:
-        st.markdown('<div class="subheader"><h3>Video Preview</h3></div>', unsafe_allow_html=True)
+        subheader("Video Preview")
         result_container = st.container(height=500, border=False) # Add fixed height for preview area
 
-        # Display placeholder if not generating and no video is present
-        if not st.session_state.generating and not st.session_state.last_generated_video:
-             with result_container:
-                st.markdown(f"<div class='video-placeholder'><span>🖼️</span>Your generated video will appear here.</div>", unsafe_allow_html=True)
-
-        # Handle Generation Button Click
+        # Handle Generation Button Click - start generating in this same run instead of rerunning first
         if generate_btn:
             if not st.session_state.prompt.strip():
                 st.warning("Please enter a prompt before generating a video.")
                 st.session_state.generating = False # Ensure flag is reset if prompt empty
             else:
-                # Set generating flag to True and rerun to disable button/show progress
                 st.session_state.generating = True
+                st.session_state.generation_request = {
+                    "prompt": st.session_state.prompt,
+                    "duration": duration,
+                    "aspect_ratio": aspect_ratio
+                }
                 st.session_state.last_generated_video = None # Clear previous result
-                st.rerun() # Rerun to update UI (disable button, show progress)
+
+        # Surface the outcome of a failed generation from the previous run - once, so later reruns don't repeat it
+        generation_error = st.session_state.pop("generation_error", None)
+        if generation_error:
+            with result_container:
+                st.error(f"⚠️ {generation_error}")
+
+        # Display placeholder if not generating and no video is present
+        if not st.session_state.generating and not st.session_state.last_generated_video:
+             with result_container:
+                st.markdown(f"<div class='video-placeholder'><span>🖼️</span>Your generated video will appear here.</div>", unsafe_allow_html=True)
 
         # Show progress and generate video if the generating flag is set
+        # (also resumes a generation whose run was interrupted by a widget interaction)
         if st.session_state.generating:
+            generate_slot.button("⏳ Generating...", disabled=True, use_container_width=True, key="generate_button_busy")
+            request = st.session_state.generation_request
             with result_container: # Display progress within the result container
                 progress_bar = st.progress(0, text="Initializing...")
                 status_text = st.empty() # Use for more detailed status
-                # Create a unique output path for each generation attempt
-                output_path = os.path.join("generated_videos", f"video_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4")
-                # Ensure the output directory exists
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
-
+                # Create a unique download filename for each generation attempt
+                output_filename = f"video_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4"
 
                 try:
-                    # Initialization step
-                    status_text.text("🔄 Connecting to API...")
-                    progress_bar.progress(10, text="Initializing...")
-                    time.sleep(0.5)
-
-                    # Generation step
+                    # Generation step (progress advances on real milestones only - no decorative sleeps)
                     status_text.text("✨ Requesting video generation (this may take several minutes)...")
-                    progress_bar.progress(30, text="Generating...")
+                    progress_bar.progress(10, text="Generating...")
+
+                    # Submit at most one Vertex job per request: if a rerun (e.g. a widget touched while
+                    # waiting) interrupted polling, resume the job already running instead of billing a new one
+                    op_key = generation_key(request["prompt"], request["duration"], request["aspect_ratio"])
+                    inflight = st.session_state.inflight_op
+                    if inflight and inflight["key"] == op_key:
+                        error = None
+                    else:
+                        operation_name, error = submit_video_generation(request["prompt"], request["duration"], request["aspect_ratio"])
+                        if not error:
+                            inflight = st.session_state.inflight_op = {"key": op_key, "name": operation_name, "submitted": time.monotonic()}
+
+                    def show_progress(elapsed, percent):
+                        # Use the job's own progress when reported; otherwise ease toward (never reaching) the download step
+                        fraction = percent / 100 if percent else elapsed / (elapsed + 60)
+                        progress_bar.progress(10 + int(65 * fraction), text=f"Generating... ({int(elapsed)}s elapsed)")
 
-                    # Call generate_video
-                    video_uri, error = generate_video(st.session_state.prompt, duration, aspect_ratio)
+                    if not error:
+                        video_uri, error = poll_video_generation(inflight["name"], on_progress=show_progress, started=inflight["submitted"])
+                    # Only a finished job clears the marker; a rerun interrupting the poll leaves it for resumption
+                    st.session_state.inflight_op = None
 
                     if error:
-                        status_text.empty()
-                        progress_bar.empty()
-                        st.error(f"⚠️ Generation failed: {error}")
-                        st.session_state.generating = False # Reset flag on error
-                        st.rerun() # Rerun to show error and enable button
+                        st.session_state.generation_error = f"Generation failed: {error}"
                     else:
-                        # Processing step
-                        status_text.text("🎞️ Processing video response...")
-                        progress_bar.progress(80, text="Processing...")
-                        time.sleep(0.5)
-
                         # Download step
                         status_text.text(f"⬇️ Downloading video from GCS...") # Simplified message
+                        progress_bar.progress(80, text="Downloading...")
                         # st.text(f"⬇️ Downloading video from {video_uri}...") # Original message
-                        if download_from_gcs(video_uri, output_path):
-                            progress_bar.progress(90, text="Downloading...")
-                            # Complete
-                            status_text.text("✅ Video generation complete!")
+                        try:
+                            fetch_blob_bytes(video_uri) # Load once into the byte cache shared by preview + download
                             progress_bar.progress(100, text="Complete!")
-                            time.sleep(1)
+                            status_text.text("✅ Video generation complete!")
+
+                            # New video in the bucket - drop the cached library listing
+                            clear_video_uri_cache()
 
                             # Store success state
                             st.session_state.last_generated_video = {
-                                "path": output_path,
+                                "file_name": output_filename,
                                 "uri": video_uri,
-                                "prompt": st.session_state.prompt,
-                                "duration": duration,
-                                "aspect_ratio": aspect_ratio,
+                                "prompt": request["prompt"],
+                                "duration": request["duration"],
+                                "aspect_ratio": request["aspect_ratio"],
                                 "timestamp": datetime.now()
                             }
-                            st.session_state.generating = False # Reset flag on success
-                            st.rerun() # Rerun to display the video and details below
-                        else:
+                        except ScriptControlException:
+                            raise # Interrupted mid-download: the next run resumes (picked up by the outer handler)
+                        except Exception as e:
                             # Handle download failure
-                            status_text.empty()
-                            progress_bar.empty()
-                            st.error(f"⚠️ Video generated ({video_uri}) but failed to download for preview.")
-                            st.session_state.generating = False # Reset flag
-                            st.rerun() # Rerun to show error and enable button
+                            st.session_state.generation_error = f"Video generated ({video_uri}) but failed to download for preview: {e}"
 
+                except ScriptControlException:
+                    # A widget interaction interrupted this run: keep generating/generation_request/inflight_op
+                    # as they are so the next run resumes polling the same Vertex job instead of abandoning it
+                    raise
                 except Exception as e:
                     # Catch unexpected errors during the generation process
-                    st.error(f"An unexpected error occurred: {e}")
-                    st.session_state.generating = False # Ensure flag is reset
-                    # Safely clear progress indicators if they exist
-                    if 'progress_bar' in locals() and hasattr(progress_bar, 'empty'): progress_bar.empty()
-                    if 'status_text' in locals() and hasattr(status_text, 'empty'): status_text.empty()
-                    st.rerun() # Rerun to reflect error state
+                    st.session_state.generation_error = f"An unexpected error occurred: {e}"
+                    st.session_state.inflight_op = None
+
+                # Single rerun per generation: re-enables the button and renders the result (or error) from state.
+                # Only reached once the job finished or failed - an interrupted run re-raised above and skips this reset
+                st.session_state.generating = False
+                st.rerun()
 
 
         # Display the last successfully generated video if it exists and not currently generating
@@ -538,17 +660,12 @@ with tab1:
                 video_info = st.session_state.last_generated_video
                 st.success("✅ Video generated successfully!")
                 try:
-                    # Check if file exists before trying to display
-                    if os.path.exists(video_info["path"]):
-                         st.video(video_info["path"])
-                    else:
-                         st.error(f"Error: Video file not found at {video_info['path']}. It might have been moved or deleted.")
-                         st.session_state.last_generated_video = None # Clear invalid state
-                         st.rerun() # Rerun to update UI
+                    # Read the video once (cached by URI) and feed the same bytes to the player and download button
+                    video_bytes = fetch_blob_bytes(video_info["uri"])
+                    st.video(video_bytes)
                 except Exception as e:
                      st.error(f"Error displaying video: {e}")
-                     st.session_state.last_generated_video = None # Clear invalid state
-                     st.rerun() # Rerun to update UI
+                     st.session_state.last_generated_video = None # Clear invalid state (skips the download section below)
 
 
                 # Download button and metadata (only if video displayed successfully and state is valid)
@@ -556,19 +673,14 @@ with tab1:
                     dl_col, _ = st.columns([1, 1]) # Only need download column now
                     with dl_col:
                         try:
-                            # Check file exists before opening for download
-                            if os.path.exists(video_info["path"]):
-                                with open(video_info["path"], "rb") as fp:
-                                    st.download_button(
-                                        "⬇️ Download Video",
-                                        data=fp,
-                                        file_name=os.path.basename(video_info["path"]), # Use actual filename
-                                        mime="video/mp4",
-                                        use_container_width=True,
-                                        key="download_generated"
-                                    )
-                            else:
-                                st.error("Download failed: Source file not found.")
+                            st.download_button(
+                                "⬇️ Download Video",
+                                data=video_bytes,
+                                file_name=video_info["file_name"],
+                                mime="video/mp4",
+                                use_container_width=True,
+                                key="download_generated"
+                            )
                         except Exception as e:
                             st.error(f"Error preparing download: {e}")
 
@@ -586,28 +698,33 @@ with tab1:
 
 
 # --- Library Tab ---
-with tab2:
-    st.markdown('<div class="subheader"><h3>Your Generated Videos</h3></div>', unsafe_allow_html=True)
-
+def open_library():
+    """Marks the library as opened so later reruns render it."""
+    st.session_state.library_opened = True
+
+# A fragment: searching and paging rerun only the library, not the generate tab above it
+@st.fragment
+def render_library():
+    """Renders the searchable, paginated grid of generated videos (lists and fetches from GCS)."""
     # Search and filter controls
     filter_col1, filter_col2 = st.columns([3, 1])
     with filter_col1:
         search_query = st.text_input("🔍 Search by filename", placeholder="Enter part of a filename...", key="search_library")
     with filter_col2:
-        # Sorting is now handled by list_video_uris (newest first)
+        # Sorting is now handled by list_videos (newest first)
         st.markdown("**Sorted by:** Newest First") # Indicate default sort
 
-    # Get video list (cached) - Pass dummy args matching the function signature
-    all_uris = list_video_uris(GCS_BUCKET_NAME, GCS_SUBFOLDER)
+    # Get video list (cached across sessions for LIBRARY_CACHE_TTL seconds)
+    listing = list_videos(GCS_BUCKET_NAME, GCS_SUBFOLDER)
 
     # Filter by search query if provided
     if search_query:
-        filtered_uris = [uri for uri in all_uris if search_query.lower() in uri.lower()]
+        filtered_videos = search_videos(listing, search_query)
     else:
-        filtered_uris = all_uris
+        filtered_videos = listing[0]
 
     # --- Pagination Logic ---
-    total_videos = len(filtered_uris)
+    total_videos = len(filtered_videos)
     if total_videos == 0:
         if search_query:
             st.info(f"📭 No videos found matching '{search_query}'.")
@@ -623,13 +740,8 @@ with tab2:
             st.session_state.current_page = 1
 
         # --- Pagination Controls ---
-        st.markdown('<div class="pagination-container">', unsafe_allow_html=True)
-        # "Previous" button
-        prev_disabled = st.session_state.current_page <= 1
-        if st.button("⬅️ Previous", disabled=prev_disabled, key="prev_page"):
-            st.session_state.current_page -= 1
-            st.rerun() # Use st.rerun()
-        # Page indicator - Use number input for direct page selection
+        # A single number input (its +/- steppers act as Previous/Next) updates the page in the
+        # widget's own rerun, so navigating never triggers a second, explicit rerun
         page_selection = st.number_input(
                 f"Page (1-{total_pages})",
                 min_value=1, max_value=total_pages,
@@ -639,14 +751,6 @@ with tab2:
             )
         if page_selection != st.session_state.current_page:
              st.session_state.current_page = page_selection
-             st.rerun() # Use st.rerun()
-
-        # "Next" button
-        next_disabled = st.session_state.current_page >= total_pages
-        if st.button("Next ➡️", disabled=next_disabled, key="next_page"):
-            st.session_state.current_page += 1
-            st.rerun() # Use st.rerun()
-        st.markdown('</div>', unsafe_allow_html=True)
 
         # Page info text
         st.markdown(f"""<div class="pagination-info">
@@ -657,7 +761,20 @@ with tab2:
         # Calculate start and end index for the current page
         start_idx = (st.session_state.current_page - 1) * VIDEOS_PER_PAGE
         end_idx = start_idx + VIDEOS_PER_PAGE
-        uris_to_display = filtered_uris[start_idx:end_idx]
+        videos_to_display = filtered_videos[start_idx:end_idx]
+        # Filenames and widget keys were derived when listing; date labels are memoized by format_card_date.
+        # Dates come straight from the listing's timeCreated (UTC);
+        # adjust for timezone if needed, e.g., .astimezone(pytz.timezone('America/New_York'))
+        page_items = [
+            (
+                video.key,
+                video.uri,
+                video.filename,
+                format_card_date(video.created),
+                video.size
+            )
+            for video in videos_to_display
+        ]
 
         # --- Display Videos ---
         library_container = st.container()
@@ -666,101 +783,49 @@ with tab2:
             num_columns = 3
             cols = st.columns(num_columns)
 
-            for i, uri in enumerate(uris_to_display):
-                with cols[i % num_columns]:
-                    # Define a unique temp file path for each video shown
-                    # Use a subfolder to keep things tidy
-                    temp_dir = "temp_previews"
-                    # Ensure the temp directory exists
-                    os.makedirs(temp_dir, exist_ok=True)
-                    # Create filename based on GCS path to avoid collisions and invalid chars
-                    safe_filename_base = os.path.basename(uri).replace(":", "_").replace("/", "_")
-                    temp_file_path = os.path.join(temp_dir, f"preview_{safe_filename_base}")
-
-                    st.markdown(f"<div class='video-card'>", unsafe_allow_html=True)
-                    filename = os.path.basename(uri) # Get original filename for display
-
-                    # Display Title
-                    st.markdown(f"<div class='video-title'>{filename}</div>", unsafe_allow_html=True)
-
-                    # Attempt to get and display date (from local temp file if exists)
-                    file_date_str = "Date unknown"
-                    try:
-                        if os.path.exists(temp_file_path):
-                           file_timestamp = os.path.getctime(temp_file_path)
-                           file_date_str = datetime.fromtimestamp(file_timestamp).strftime('%Y-%m-%d %H:%M')
-                        # Alternative: Fetch GCS blob metadata for accurate creation time (more robust but slower)
-                        # blob = storage_client.get_bucket(GCS_BUCKET_NAME).get_blob(uri.replace(f"gs://{GCS_BUCKET_NAME}/", ""))
-                        # if blob and blob.time_created:
-                        #    # Adjust for timezone if needed, e.g., .astimezone(pytz.timezone('America/New_York'))
-                        #    file_date_str = blob.time_created.strftime('%Y-%m-%d %H:%M')
-                    except Exception as e:
-                        # st.warning(f"Could not get date for {filename}: {e}") # Optional warning
-                        pass # Ignore errors getting date silently
-                    st.markdown(f"<div class='video-date'>{file_date_str}</div>", unsafe_allow_html=True)
+            for i, (item_key, uri, filename, file_date_str, size) in enumerate(page_items):
+                # A bordered container is the card itself: it wraps every element below, which raw
+                # <div> open/close markdown calls cannot (each st.markdown renders as its own block)
+                with cols[i % num_columns], st.container(border=True):
+                    # Title and date in a single markdown element
+                    st.markdown(
+                        f"<div class='video-title'>{filename}</div><div class='video-date'>{file_date_str}</div>",
+                        unsafe_allow_html=True
+                    )
 
                     # Video content area
-                    st.markdown('<div class="video-content">', unsafe_allow_html=True)
                     video_placeholder = st.empty()
-                    # Flag to track if video is successfully displayed/downloaded
-                    video_ready = False
                     try:
-                        # Download only if the temp file doesn't exist
-                        needs_download = not os.path.exists(temp_file_path)
-                        if needs_download:
-                             with video_placeholder.spinner(f"Loading video..."):
-                                if download_from_gcs(uri, temp_file_path):
-                                     video_ready = True # Mark as ready after successful download
-                                else:
-                                     video_placeholder.error("Failed to load video.")
-                                     # temp_file_path remains None or invalid
-                        else:
-                             video_ready = True # Already exists locally
-
-                        # Display video if path is valid and file exists
-                        if video_ready and os.path.exists(temp_file_path):
-                             video_placeholder.video(temp_file_path)
-                        # Handle cases where download wasn't needed but file is missing, or download failed
-                        elif not needs_download and not os.path.exists(temp_file_path):
-                             video_placeholder.error("Preview file missing.")
-                             video_ready = False # Mark as not ready
-                        elif needs_download and not video_ready: # Download failed case
-                             pass # Error already shown by spinner
-                        else: # Should not happen, but catch all
-                             video_placeholder.warning("Could not display video preview.")
-                             video_ready = False
-
+                        # Let the browser stream the preview straight from GCS instead of through this server
+                        video_placeholder.video(get_signed_url(uri))
                     except Exception as e:
                          video_placeholder.error(f"Error displaying video: {e}")
-                         video_ready = False # Mark as not ready on error
-                    st.markdown('</div>', unsafe_allow_html=True) # Close video-content
 
                     # Actions area (Download button, Expander)
-                    st.markdown('<div class="video-actions">', unsafe_allow_html=True)
-                    # Download button for the specific video - enable only if video_ready
-                    if video_ready and os.path.exists(temp_file_path):
-                         try:
-                              with open(temp_file_path, "rb") as fp:
-                                   st.download_button(
-                                        "⬇️ Download",
-                                        data=fp,
-                                        file_name=filename, # Original filename for download
-                                        mime="video/mp4",
-                                        key=f"download_{start_idx + i}", # Ensure unique key per page item
-                                        use_container_width=True
-                                   )
-                         except Exception as e:
-                              st.error(f"Download error: {e}")
-                              st.button("Download Error", disabled=True, use_container_width=True, key=f"download_{start_idx + i}_err")
-                    else:
-                        # Show a disabled button if preview failed or file missing
-                         st.button("Download Unavailable", disabled=True, use_container_width=True, key=f"download_{start_idx + i}_disabled")
-
+                    # Download link for the specific video - the browser fetches it from GCS, so no bytes pass through this server
+                    try:
+                        st.link_button(
+                            "⬇️ Download",
+                            get_signed_url(uri, download_filename=filename), # Original filename for download
+                            use_container_width=True
+                        )
+                    except Exception as e:
+                        st.button("Download Unavailable", disabled=True, help=str(e), use_container_width=True, key=f"download_{item_key}_disabled")
 
-                    # Details Expander (URI)
+                    # Details Expander (URI) - its contents are sent even while collapsed, so keep them to two elements
                     with st.expander("Details"):
-                        st.markdown(f"**GCS URI:**")
+                        size_line = f"**Size:** {size / (1024 * 1024):.1f} MB  \n" if size is not None else ""
+                        st.markdown(f"{size_line}**GCS URI:**")
                         st.code(uri, language=None) # Use st.code for better wrapping/copying
 
-                    st.markdown("</div>", unsafe_allow_html=True) # Close video-actions
-                    st.markdown("</div>", unsafe_allow_html=True) # Close video-card div
+
+with tab2:
+    subheader("Your Generated Videos")
+
+    # Streamlit runs every tab's code on every rerun, so hold off on GCS listing/downloads
+    # until the user actually asks for the library instead of paying for them on tab1 interactions
+    if st.session_state.library_opened:
+        render_library()
+    else:
+        st.info("📂 Load your library to browse previously generated videos.")
+        st.button("📂 Load Video Library", on_click=open_library, key="load_library")